@@ -1,25 +1,106 @@
 # Save as test_connection.py
+import select
 import socket
 import os
 from dotenv import load_dotenv
 
 load_dotenv()
 
-def test_supabase_connection():
+# Simple in-process DNS cache so repeated runs (or future callers) don't hit
+# the system resolver every time. Entries expire after DNS_CACHE_TTL seconds.
+DNS_CACHE_TTL = 300.0
+_dns_cache = {}  # hostname -> (ip, expires_at)
+
+def resolve_host(host):
+    """Resolve a hostname to an IP, caching the result for DNS_CACHE_TTL seconds.
+
+    Raises socket.gaierror just like socket.gethostbyname on failure.
+    """
+    import time
+
+    cached = _dns_cache.get(host)
+    if cached is not None:
+        ip, expires_at = cached
+        if time.monotonic() < expires_at:
+            return ip
+
+    ip = socket.gethostbyname(host)
+    _dns_cache[host] = (ip, time.monotonic() + DNS_CACHE_TTL)
+    return ip
+
+def resolve_host_with_timeout(host, timeout=2.0):
+    """resolve_host with its own time budget.
+
+    socket.gethostbyname has no per-call timeout, so run the lookup in a
+    worker thread and give up after `timeout` seconds. Raises socket.gaierror
+    on resolver failure or socket.timeout if the budget expires.
+    """
+    import concurrent.futures
+
+    # No `with` block here: the context manager would call shutdown(wait=True)
+    # and block until gethostbyname actually returns, making the timeout
+    # meaningless. Shut down without waiting and let the stuck worker thread
+    # finish (and die) in the background instead.
+    pool = concurrent.futures.ThreadPoolExecutor(max_workers=1)
+    future = pool.submit(resolve_host, host)
+    try:
+        return future.result(timeout=timeout)
+    except concurrent.futures.TimeoutError:
+        raise socket.timeout(f"DNS lookup for {host} exceeded {timeout}s")
+    finally:
+        pool.shutdown(wait=False)
+
+def check_port(host, port, timeout=2.0):
+    """Non-blocking TCP connect check with a bounded select() timeout.
+
+    Returns 0 on success, a socket errno on refusal/unreachable, or
+    errno.ETIMEDOUT if select() expires (e.g. a filtered port). Much faster
+    than a blocking connect_ex with a 10s settimeout when the port is
+    filtered, since we only wait as long as the select() budget.
+    """
+    import errno
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setblocking(False)
+    try:
+        try:
+            sock.connect((host, port))
+        except BlockingIOError:
+            pass  # Expected: connect is in progress on a non-blocking socket
+
+        _, writable, errored = select.select([], [sock], [sock], timeout)
+        if not writable and not errored:
+            return errno.ETIMEDOUT
+
+        # Connect finished (or failed) - the real result is in SO_ERROR
+        return sock.getsockopt(socket.SOL_SOCKET, socket.SO_ERROR)
+    finally:
+        sock.close()
+
+def test_supabase_connection(dns_timeout=2.0, connect_timeout=3.0):
     database_url = os.getenv('DATABASE_URL', '')
     print(f"DATABASE_URL loaded: {database_url[:50]}..." if database_url else "DATABASE_URL not found!")
-    
+
     host = 'db.amuuoaojbxicmeslqeem.supabase.co'
-    port = 5432
-    
+    # 5432 = direct Postgres, 6543 = transaction-mode pooler (pgbouncer).
+    # The pooler is the recommended target for DATABASE_URL.
+    ports = {5432: 'direct Postgres', 6543: 'connection pooler'}
+
     print(f"\n=== Testing Supabase Connection ===")
     print(f"Host: {host}")
-    print(f"Port: {port}\n")
-    
-    # Test 1: DNS Resolution
+    print(f"Ports: {', '.join(str(p) for p in ports)}\n")
+
+    # Test 1: DNS Resolution (separate budget so a slow resolver doesn't
+    # eat into the TCP connect test, and vice versa)
     try:
-        ip = socket.gethostbyname(host)
+        ip = resolve_host_with_timeout(host, timeout=dns_timeout)
         print(f"✓ DNS Resolution: SUCCESS → {ip}")
+    except socket.timeout as e:
+        print(f"✗ DNS Resolution: TIMED OUT after {dns_timeout}s → {e}")
+        print("\nPossible causes:")
+        print("  - Slow or overloaded DNS server")
+        print("  - VPN/Proxy interference")
+        return False
     except socket.gaierror as e:
         print(f"✗ DNS Resolution: FAILED → {e}")
         print("\nPossible causes:")
@@ -28,27 +109,30 @@ def test_supabase_connection():
         print("  - Firewall blocking DNS queries")
         print("  - VPN/Proxy interference")
         return False
-    
-    # Test 2: Port Connectivity
-    try:
-        sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
-        sock.settimeout(10)
-        result = sock.connect_ex((host, port))
-        sock.close()
-        
-        if result == 0:
-            print(f"✓ Port {port}: ACCESSIBLE")
-            return True
-        else:
-            print(f"✗ Port {port}: NOT ACCESSIBLE (Error code: {result})")
-            print("\nPossible causes:")
-            print("  - Firewall blocking port 5432")
-            print("  - Company network restrictions")
-            print("  - Supabase project paused/deleted")
-            return False
-    except Exception as e:
-        print(f"✗ Port test failed: {e}")
-        return False
+
+    # Test 2: Port Connectivity (its own budget, independent of DNS).
+    # Connect to the IP from Test 1 - passing the hostname would make
+    # connect() redo a blocking DNS lookup inside the non-blocking path.
+    any_accessible = False
+    for port, label in ports.items():
+        try:
+            result = check_port(ip, port, timeout=connect_timeout)
+
+            if result == 0:
+                print(f"✓ Port {port} ({label}): ACCESSIBLE")
+                any_accessible = True
+            else:
+                print(f"✗ Port {port} ({label}): NOT ACCESSIBLE (Error code: {result})")
+        except Exception as e:
+            print(f"✗ Port {port} ({label}) test failed: {e}")
+
+    if not any_accessible:
+        print("\nPossible causes:")
+        print("  - Firewall blocking ports 5432/6543")
+        print("  - Company network restrictions")
+        print("  - Supabase project paused/deleted")
+
+    return any_accessible
 
 if __name__ == "__main__":
     test_supabase_connection()
\ No newline at end of file
@@ -1,11 +1,21 @@
 import os
 import streamlit as st
 from dotenv import load_dotenv
-from openai import OpenAI
-from mem0 import Memory
+# The heavy SDKs (openai, mem0) are imported lazily inside their cached
+# resource factories so cold start of the login screen only pays for
+# streamlit + the supabase client.
 import supabase
 from supabase.client import Client, ClientOptions
+# httpx stays at module scope - the tenacity retry predicate and client
+# timeouts need it at import time, and the supabase import has already
+# loaded it transitively anyway; tenacity is tiny
+import httpx
+import tenacity
 from pathlib import Path
+from contextlib import contextmanager
+from operator import itemgetter
+import hashlib
+import time
 import uuid
 import sys
 
@@ -30,24 +40,133 @@ dotenv_path = project_root / '.env'
 # If the .env file is still in a subfolder, e.g., S:\Mem0\studio-integration-version\.env, use this instead:
 # dotenv_path = project_root / 'studio-integration-version' / '.env'
 
-load_dotenv(dotenv_path, override=True)
-load_dotenv()
+# Parse the .env file once per process. Streamlit reruns this whole module
+# on every widget interaction, and re-reading + re-parsing the file each
+# time (previously twice per rerun) is pure file-system overhead.
+@st.cache_resource
+def _load_env():
+    load_dotenv(dotenv_path, override=True)
+    return True
 
-# Initialize Supabase client
-supabase_url = os.environ.get("SUPABASE_URL", "")
-supabase_key = os.environ.get("SUPABASE_KEY", "")
-supabase_client = supabase.create_client(supabase_url, supabase_key)
+_load_env()
 
 model = os.getenv('MODEL_CHOICE', 'gpt-4o-mini')
+# Streamlit keeps session state alive long after a tab closes, so an
+# unbounded chat transcript leaks memory. Long-term recall lives in Mem0
+# anyway - the on-screen history only needs the recent window.
+max_history = int(os.getenv('MAX_HISTORY', '100'))
 # -----------------------------------------------------------------
 
-# --- 3. CACHED RESOURCES (OpenAI Client and Mem0) ---
+# --- 3. CACHED RESOURCES (Supabase, OpenAI Client and Mem0) ---
+@st.cache_resource
+def get_supabase_client():
+    # Build the Supabase client once and reuse it across script reruns.
+    # Streamlit reruns this whole module on every widget interaction, so a
+    # module-level create_client() would pay the TLS handshake every time.
+    supabase_url = os.environ.get("SUPABASE_URL", "")
+    supabase_key = os.environ.get("SUPABASE_KEY", "")
+    # The pinned supabase==2.13.0 ClientOptions has no httpx_client field,
+    # so a custom HTTP/2 keepalive transport can't be injected here yet -
+    # caching the client at least keeps gotrue/postgrest's own pooled
+    # connections alive across reruns. Revisit if the supabase pin is bumped
+    # to a version whose sync options accept httpx_client.
+    return supabase.create_client(
+        supabase_url,
+        supabase_key,
+        options=ClientOptions(
+            postgrest_client_timeout=10,
+            storage_client_timeout=10,
+        ),
+    )
+
+@st.cache_resource
+def get_io_pool():
+    # Shared worker pool for network-bound side work (memory writes etc.)
+    # so the chat path doesn't block on them.
+    from concurrent.futures import ThreadPoolExecutor
+    return ThreadPoolExecutor(max_workers=4)
+
+@st.cache_resource
+def get_pg_pool():
+    # One Postgres connection pool shared by all the direct-SQL helpers
+    # (rerank search, keyword search, chunked clear). Opening a fresh
+    # connection per call would pay a full TCP+TLS+auth handshake each time
+    # - the exact overhead these fast paths exist to avoid.
+    from psycopg2.pool import ThreadedConnectionPool
+    return ThreadedConnectionPool(minconn=1, maxconn=10, dsn=os.environ['DATABASE_URL'])
+
+@st.cache_resource
+def _get_search_cache():
+    # Persistent container for search results. Streamlit re-executes this
+    # script into a fresh module namespace on every interaction, so any
+    # module-level cache (an lru_cache included) would be recreated empty
+    # each rerun and never produce a cross-turn hit. A dict handed out by
+    # cache_resource survives reruns; fetched once on the main thread, it
+    # can then be read/written by worker threads as a plain dict.
+    return {}
+
+@st.cache_resource
+def _get_embed_cache():
+    # Same idea for query embeddings: the dict must outlive the rerun
+    return {}
+
 @st.cache_resource
 def get_openai_client():
-    return OpenAI()
+    from openai import OpenAI
+    # Hard per-call bounds so one slow upstream can't freeze the Streamlit
+    # worker; the SDK retries transient failures itself.
+    return OpenAI(timeout=httpx.Timeout(20.0, connect=3.0), max_retries=2)
+
+def _bootstrap_vector_index(database_url):
+    # Without an ANN index pgvector brute-force scans the whole collection
+    # on every search. Mem0's supabase provider (vecs) stores collections as
+    # vecs."<collection>" with the embedding in the "vec" column, so create
+    # an HNSW index there if it's missing and tune ef_search for future
+    # sessions. Also maintain a generated tsvector column + GIN index over
+    # the memory text so hybrid (keyword + vector) retrieval stays cheap.
+    # Best-effort: a failure just means slower (but correct) search.
+    import psycopg2
+
+    conn = psycopg2.connect(database_url)
+    try:
+        conn.autocommit = True
+        with conn.cursor() as cur:
+            # vecs creates its own ANN index (under its own name) when the
+            # collection is first indexed, so look for any existing hnsw or
+            # ivfflat index on the table rather than blindly creating a
+            # second one - duplicate ANN indexes double the maintenance
+            # cost of every insert.
+            cur.execute(
+                "SELECT 1 FROM pg_indexes "
+                "WHERE schemaname = 'vecs' AND tablename = 'memories' "
+                "AND (indexdef LIKE '%USING hnsw%' OR indexdef LIKE '%USING ivfflat%');"
+            )
+            if cur.fetchone() is None:
+                cur.execute(
+                    'CREATE INDEX IF NOT EXISTS memories_vec_hnsw '
+                    'ON vecs."memories" USING hnsw (vec vector_cosine_ops) '
+                    'WITH (m = 16, ef_construction = 64);'
+                )
+            # Applies at login for every later connection (including Mem0's)
+            cur.execute('ALTER ROLE CURRENT_USER SET hnsw.ef_search = 40;')
+            # Full-text search column + index for the keyword half of hybrid
+            # retrieval (to_tsvector with an explicit config is immutable,
+            # so it can back a generated column)
+            cur.execute(
+                'ALTER TABLE vecs."memories" ADD COLUMN IF NOT EXISTS content_tsv tsvector '
+                "GENERATED ALWAYS AS (to_tsvector('english', coalesce(metadata->>'data', ''))) STORED;"
+            )
+            cur.execute(
+                'CREATE INDEX IF NOT EXISTS memories_fts '
+                'ON vecs."memories" USING GIN (content_tsv);'
+            )
+    finally:
+        conn.close()
 
 @st.cache_resource
 def get_memory():
+    from mem0 import Memory
+
     # CRITICAL: This line will raise a KeyError if DATABASE_URL is missing or empty!
     # Ensure DATABASE_URL is correctly set in your .env file.
     database_url = os.environ.get('DATABASE_URL')
@@ -56,6 +175,17 @@ def get_memory():
         # Raise an exception to stop execution gracefully if resources aren't available
         raise ValueError("DATABASE_URL must be set in your .env file.")
 
+    # Direct connections to port 5432 open a fresh TCP+TLS+auth session per
+    # Mem0 operation. Supabase's transaction-mode pooler (pgbouncer, port
+    # 6543) keeps server connections warm, shaving hundreds of ms off every
+    # search/add. Nudge users towards it without refusing the direct URL.
+    if 'pooler.supabase.com' not in database_url and ':6543' not in database_url:
+        st.warning(
+            "DATABASE_URL points at a direct Postgres connection. For lower "
+            "latency, use the Supabase Connection Pooler URI "
+            "(…pooler.supabase.com:6543) from your project's database settings."
+        )
+
     config = {
         "llm": {
             "provider": "openai",
@@ -71,15 +201,34 @@ def get_memory():
             }
         }
     }
-    return Memory.from_config(config)
+    mem = Memory.from_config(config)
+
+    # Make sure vector search uses an ANN index rather than a full scan
+    try:
+        _bootstrap_vector_index(database_url)
+    except Exception as e:
+        st.warning(f"Could not ensure vector index (search may be slow): {e}")
+
+    return mem
 
 # Get cached resources
 try:
+    supabase_client = get_supabase_client()
     openai_client = get_openai_client()
     memory = get_memory()
+    _io_pool = get_io_pool()
+    _search_cache = _get_search_cache()
+    _embed_cache = _get_embed_cache()
 except ValueError:
     # If get_memory failed (due to missing DATABASE_URL), stop here
     st.stop()
+
+# Best-effort: if the pool can't be built (direct Postgres unreachable),
+# the fast SQL paths raise and fall back to Mem0's own APIs instead.
+try:
+    _pg_pool = get_pg_pool()
+except Exception:
+    _pg_pool = None
 # -----------------------------------------------------------------
 
 
@@ -122,6 +271,9 @@ def sign_in(email, password):
 
 def sign_out():
     try:
+        # Persist any buffered conversation turns before the session ends
+        if st.session_state.get("user"):
+            flush_pending_memories(st.session_state.user.id)
         supabase_client.auth.sign_out()
         st.session_state.authenticated = False
         st.session_state.user = None
@@ -133,22 +285,303 @@ def sign_out():
 
 
 # --- 5. CHAT LOGIC ---
+# Constant parts of the system prompt, built once at import instead of
+# re-formatted on every turn
+_SYS_PREFIX = (
+    "You are a helpful AI assistant with memory. Answer the question based "
+    "on the query and user's memories.\nUser Memories:\n"
+)
+_SYS_NO_MEMORIES = (
+    "You are a helpful AI assistant with memory. Answer the question based "
+    "on the query."
+)
+
+# Moves the per-entry dict lookup into C for the memories join - matters
+# once the candidate count grows beyond the old limit=3
+_get_memory_text = itemgetter('memory')
+
+# How many ANN candidates to prefetch before the exact client-side rerank
+RERANK_CANDIDATES = 20
+SEARCH_LIMIT = 3
+
+@contextmanager
+def _pooled_conn():
+    # Borrow a warm connection from the shared pool; raises if the pool
+    # couldn't be built so callers hit their Mem0 fallbacks. The rollback
+    # before putconn ends any open transaction. Note that it also reverts
+    # any GUCs SET inside that transaction - callers needing a tuned
+    # setting must SET LOCAL it per transaction (the bootstrap's
+    # ALTER ROLE ... SET provides the session default).
+    if _pg_pool is None:
+        raise RuntimeError("Postgres connection pool unavailable")
+    conn = _pg_pool.getconn()
+    try:
+        yield conn
+    finally:
+        conn.rollback()
+        _pg_pool.putconn(conn)
+
+def _prefetch_rerank_search(user_id, query):
+    # Fast search path: one SQL roundtrip pulls RERANK_CANDIDATES approximate
+    # nearest neighbours from the HNSW index, then NumPy reranks them with
+    # exact cosine similarity and keeps the top SEARCH_LIMIT. This skips
+    # Mem0's own search machinery while returning the same result shape.
+    import numpy as np
+    from pgvector.psycopg2 import register_vector
+
+    query_vec = np.asarray(get_query_embedding(query), dtype=np.float32)
+
+    with _pooled_conn() as conn:
+        register_vector(conn)
+        with conn.cursor() as cur:
+            # LOCAL: scoped to this transaction by design - _pooled_conn's
+            # rollback would revert a plain SET anyway
+            cur.execute('SET LOCAL hnsw.ef_search = 40;')
+            cur.execute(
+                'SELECT metadata->>\'data\', vec FROM vecs."memories" '
+                "WHERE metadata->>'user_id' = %s ORDER BY vec <=> %s LIMIT %s;",
+                (user_id, query_vec, RERANK_CANDIDATES),
+            )
+            rows = cur.fetchall()
+
+    if not rows:
+        return {"results": []}
+
+    texts = [row[0] for row in rows]
+    candidates = np.asarray([row[1] for row in rows], dtype=np.float32)
+    sims = candidates @ query_vec / (
+        np.linalg.norm(candidates, axis=1) * np.linalg.norm(query_vec) + 1e-12
+    )
+    top = np.argsort(-sims)[:SEARCH_LIMIT]
+    return {"results": [{"memory": texts[i]} for i in top]}
+
+def _keyword_search(user_id, query, limit=RERANK_CANDIDATES):
+    # Keyword half of hybrid retrieval: GIN-indexed full-text match over
+    # the memory text, ranked by ts_rank. Orders of magnitude faster than a
+    # LIKE scan and catches exact terms the embedding may blur.
+    with _pooled_conn() as conn:
+        with conn.cursor() as cur:
+            cur.execute(
+                'SELECT metadata->>\'data\' FROM vecs."memories" '
+                "WHERE metadata->>'user_id' = %s "
+                "AND content_tsv @@ plainto_tsquery('english', %s) "
+                "ORDER BY ts_rank(content_tsv, plainto_tsquery('english', %s)) DESC "
+                'LIMIT %s;',
+                (user_id, query, query, limit),
+            )
+            return [row[0] for row in cur.fetchall()]
+
+# Standard reciprocal-rank-fusion constant
+RRF_K = 60
+
+def hybrid_search(user_id, query):
+    # Merge vector and keyword results with reciprocal-rank fusion so a
+    # memory that ranks well on either signal surfaces in the top results.
+    vector_texts = [_get_memory_text(e) for e in _prefetch_rerank_search(user_id, query)["results"]]
+    try:
+        keyword_texts = _keyword_search(user_id, query)
+    except Exception:
+        # FTS column/index may not exist yet; vector results still stand
+        keyword_texts = []
+
+    scores = {}
+    for ranking in (vector_texts, keyword_texts):
+        for rank, text in enumerate(ranking):
+            scores[text] = scores.get(text, 0.0) + 1.0 / (RRF_K + rank + 1)
+
+    ranked = sorted(scores, key=scores.get, reverse=True)[:SEARCH_LIMIT]
+    return {"results": [{"memory": text} for text in ranked]}
+
+@tenacity.retry(
+    stop=tenacity.stop_after_attempt(3),
+    wait=tenacity.wait_exponential_jitter(initial=0.2, max=2.0),
+    retry=tenacity.retry_if_exception_type((httpx.TimeoutException, TimeoutError, ConnectionError)),
+    reraise=True,
+)
+def _mem0_search_with_retry(user_id, query):
+    # Transient network blips shouldn't cost the user their memories for a
+    # turn - retry with jittered backoff before giving up.
+    return memory.search(query=query, user_id=user_id, limit=SEARCH_LIMIT)
+
+# Bound the number of cached search results
+SEARCH_CACHE_MAX = 512
+
+def cached_search(user_id, query):
+    # Vector search is by far the slowest step in a chat turn, and users
+    # often repeat themselves. Cache results per (user, normalized query)
+    # in the rerun-persistent dict from _get_search_cache; the cache is
+    # cleared whenever memories are written or deleted so repeats after a
+    # change still see fresh results.
+    key = (user_id, query)
+    if key in _search_cache:
+        return _search_cache[key]
+
+    try:
+        result = hybrid_search(user_id, query)
+    except Exception:
+        # Anything goes wrong on the fast path (no index, schema drift,
+        # connection refused), fall back to Mem0's own search.
+        result = _mem0_search_with_retry(user_id, query)
+
+    if len(_search_cache) >= SEARCH_CACHE_MAX:
+        # Evict the oldest insertion - a cheap stand-in for LRU
+        _search_cache.pop(next(iter(_search_cache)), None)
+    _search_cache[key] = result
+    return result
+
+# Delete at most this many memories per roundtrip when clearing, so a big
+# collection never holds locks (or a Supabase timeout) for one huge statement
+CLEAR_BATCH_SIZE = 500
+
+def clear_memories_chunked(user_id):
+    # Page through the user's memories and delete them in bounded batches,
+    # reporting progress as we go. Call duration per roundtrip stays flat
+    # no matter how many memories have accumulated. Each batch commits on
+    # its own so no long transaction holds locks on the pooled connection.
+    # The search cache is invalidated in the finally block - even a partial
+    # clear (some batches deleted before a failure) makes cached results
+    # stale, so it must run on every exit path.
+    try:
+        with _pooled_conn() as conn:
+            with conn.cursor() as cur:
+                cur.execute(
+                    'SELECT count(*) FROM vecs."memories" WHERE metadata->>\'user_id\' = %s;',
+                    (user_id,),
+                )
+                total = cur.fetchone()[0]
+                if not total:
+                    return
+
+                progress = st.progress(0.0, text="Clearing memories...")
+                deleted = 0
+                while True:
+                    cur.execute(
+                        'DELETE FROM vecs."memories" WHERE id IN ('
+                        'SELECT id FROM vecs."memories" '
+                        "WHERE metadata->>'user_id' = %s LIMIT %s);",
+                        (user_id, CLEAR_BATCH_SIZE),
+                    )
+                    conn.commit()
+                    if cur.rowcount == 0:
+                        break
+                    deleted += cur.rowcount
+                    progress.progress(
+                        min(deleted / total, 1.0),
+                        text=f"Clearing memories... ({deleted}/{total})",
+                    )
+                progress.empty()
+    finally:
+        _search_cache.clear()
+
+def get_query_embedding(text):
+    # Memoize query embeddings in the rerun-persistent dict from
+    # _get_embed_cache so repeated/similar queries don't pay another
+    # OpenAI embeddings roundtrip.
+    key = hashlib.sha1(text.encode("utf-8")).hexdigest()
+    if key not in _embed_cache:
+        response = openai_client.embeddings.create(model="text-embedding-3-small", input=text)
+        _embed_cache[key] = response.data[0].embedding
+    return _embed_cache[key]
+
+# Flush buffered conversation turns to Mem0 after this many turns or seconds,
+# whichever comes first. Batching amortizes the embedding + insert roundtrips.
+MEM_FLUSH_TURNS = 4
+MEM_FLUSH_SECONDS = 30.0
+
+# Give memory search a hard budget - past this we answer without memories
+# rather than stalling the whole turn.
+SEARCH_TIMEOUT_SECONDS = 5.0
+
+def queue_memory_turn(user_message, assistant_message, user_id):
+    # Buffer the turn and only hit Mem0 once the batch is big (or old) enough
+    pending = st.session_state.setdefault("pending_mem", [])
+    pending.append([user_message, assistant_message])
+    last_flush = st.session_state.setdefault("last_mem_flush", time.time())
+    if len(pending) >= MEM_FLUSH_TURNS or time.time() - last_flush >= MEM_FLUSH_SECONDS:
+        flush_pending_memories(user_id)
+
+def _add_after(prior, messages, user_id):
+    # Runs on the worker pool: wait for the previous add (off the UI
+    # thread), perform this one, then re-raise any prior failure so
+    # check_pending_memory_write still reports it instead of it being
+    # silently dropped when its future is replaced.
+    prior_error = prior.exception() if prior is not None else None
+    memory.add(messages, user_id=user_id)
+    if prior_error:
+        raise prior_error
+
+def flush_pending_memories(user_id):
+    pending = st.session_state.get("pending_mem") or []
+    if not pending:
+        return
+    st.session_state.pending_mem = []
+    st.session_state.last_mem_flush = time.time()
+    flattened = [msg for turn in pending for msg in turn]
+    prior = st.session_state.get("pending_add_future")
+    st.session_state.pending_add_future = _io_pool.submit(_add_after, prior, flattened, user_id)
+    # New memories may change search results, so drop cached ones
+    _search_cache.clear()
+
+def check_pending_memory_write():
+    # Surface any error from the previous turn's background memory.add
+    # without ever blocking on it.
+    future = st.session_state.get("pending_add_future")
+    if future is not None and future.done():
+        st.session_state.pending_add_future = None
+        error = future.exception()
+        if error:
+            st.warning(f"Saving memories from the last turn failed: {error}")
+
 def chat_with_memories(message, user_id):
-    # Retrieve relevant memories
-    relevant_memories = memory.search(query=message, user_id=user_id, limit=3)
-    memories_str = "\n".join(f"- {entry['memory']}" for entry in relevant_memories["results"])
+    # Retrieve relevant memories (normalize whitespace so trivially
+    # different phrasings share a cache entry)
+    from concurrent.futures import TimeoutError as FutureTimeoutError
 
-    # Generate Assistant response
-    system_prompt = f"You are a helpful AI assistant with memory. Answer the question based on the query and user's memories.\nUser Memories:\n{memories_str}"
-    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": message}]
+    # Run the search on the worker pool so it gets a hard deadline instead
+    # of blocking indefinitely. The search path computes and caches the
+    # query embedding itself, so no separate warm-up call is needed - a
+    # second submit would just race it into a duplicate OpenAI request.
+    normalized = " ".join(message.split())
+    search_future = _io_pool.submit(cached_search, user_id, normalized)
 
-    with st.spinner("Thinking..."):
-        response = openai_client.chat.completions.create(model=model, messages=messages)
-        assistant_response = response.choices[0].message.content
+    try:
+        relevant_memories = search_future.result(timeout=SEARCH_TIMEOUT_SECONDS)
+    except FutureTimeoutError:
+        st.toast("Memory search timed out - answering without memories.")
+        relevant_memories = {"results": []}
+    except Exception as e:
+        # Retries exhausted - degrade gracefully instead of failing the turn
+        st.toast(f"Memory search failed ({e}) - answering without memories.")
+        relevant_memories = {"results": []}
+    results = relevant_memories["results"]
+
+    # Generate Assistant response. Every prompt token costs latency and
+    # money, so skip the memories section entirely when there are none and
+    # truncate each memory to a sane length.
+    if results:
+        memories_str = "\n".join("- " + _get_memory_text(entry)[:256] for entry in results)
+        system_prompt = _SYS_PREFIX + memories_str
+    else:
+        system_prompt = _SYS_NO_MEMORIES
+    messages = [{"role": "system", "content": system_prompt}, {"role": "user", "content": message}]
 
-    # Create new memories from the conversation
-    messages.append({"role": "assistant", "content": assistant_response})
-    memory.add(messages, user_id=user_id)
+    # Stream the completion so the user sees tokens as they arrive instead
+    # of staring at a spinner for the whole generation.
+    stream = openai_client.chat.completions.create(model=model, messages=messages, stream=True)
+    with st.chat_message("assistant"):
+        assistant_response = st.write_stream(
+            (chunk.choices[0].delta.content or "" for chunk in stream if chunk.choices)
+        )
+
+    # Queue the turn for a batched background memory.add - the user never
+    # waits on embedding + insert roundtrips, and batching several turns
+    # into one call amortizes the network overhead. Any failure is reported
+    # at the start of the next turn.
+    queue_memory_turn(
+        {"role": "user", "content": message},
+        {"role": "assistant", "content": assistant_response},
+        user_id,
+    )
 
     return assistant_response
 # -----------------------------------------------------------------
@@ -221,7 +654,13 @@ with st.sidebar:
             # Memory management options
             st.subheader("Memory Management")
             if st.button("Clear All Memories"):
-                memory.clear(user_id=user.id)
+                try:
+                    clear_memories_chunked(user.id)
+                except Exception:
+                    # Fall back to Mem0's own clear if direct SQL fails -
+                    # and drop cached search results for this path too
+                    memory.delete_all(user_id=user.id)
+                    _search_cache.clear()
                 st.session_state.messages = []
                 st.success("All memories cleared!")
                 st.rerun()
@@ -242,6 +681,9 @@ if st.session_state.authenticated and st.session_state.user:
     user_input = st.chat_input("Type your message here...")
 
     if user_input:
+        # Report any failure from the previous turn's background memory write
+        check_pending_memory_write()
+
         # Add user message to chat history
         st.session_state.messages.append({"role": "user", "content": user_input})
 
@@ -249,15 +691,14 @@ if st.session_state.authenticated and st.session_state.user:
         with st.chat_message("user"):
             st.write(user_input)
 
-        # Get AI response
+        # Get AI response (streamed into the assistant chat bubble)
         ai_response = chat_with_memories(user_input, user_id)
 
-        # Add AI response to chat history
+        # Add AI response to chat history, keeping only the newest
+        # max_history messages so per-session memory stays bounded
         st.session_state.messages.append({"role": "assistant", "content": ai_response})
-
-        # Display AI response
-        with st.chat_message("assistant"):
-            st.write(ai_response)
+        if len(st.session_state.messages) > max_history:
+            st.session_state.messages = st.session_state.messages[-max_history:]
 else:
     st.title("Welcome to Mem0 Chat Assistant")
     st.write("Please login or sign up to start chatting with the memory-powered AI assistant.")